@@ -32,25 +32,40 @@ To really export all metrics.
 import argparse
 import collections
 import contextlib
-import json
 import logging
 import os
 import re
 import socket
 import sys
-
-import flask
+import threading
+import time
+
+from werkzeug import exceptions
+from werkzeug import serving
+from werkzeug import wrappers
+
+# orjson, or else ujson, parses large livestatus responses several times
+# faster than the standard library. Both are optional; fall back to json when
+# neither is available.
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
 
 
 # Wait no more than MAX_SOCKET_WAIT seconds for livestatus communication.
 MAX_SOCKET_WAIT = 15
 
 # Column names roughly correspond to nagios configuration names. Some names
-# are defined by the livestatus plugin.
+# are defined by the livestatus plugin. Only request columns that are exported;
+# every extra column is serialized by livestatus and parsed here for every
+# service.
 COLUMNS = [
     'host_name', 'service_description', 'state', 'latency', 'perf_data',
-    'process_performance_data', 'check_command', 'acknowledged',
-    'execution_time', 'is_flapping'
+    'check_command', 'acknowledged', 'execution_time', 'is_flapping'
 ]
 
 # Maps known units to a scaling factor for converting Nagios performance data
@@ -66,8 +81,48 @@ UNIT_TO_SCALE = {
     '%': 0.01,
 }
 
-# Extract performance data value and unit, e.g. 2400MB, 2.3%.
-UNIT_REGEX = re.compile('([0-9.]+)([^0-9.]+)?')
+# Units without a scale that have already been logged.
+_unknown_units = set()
+
+# Characters of a performance data value. The unit follows the value, e.g.
+# 2400MB, 2.3%.
+VALUE_CHARS = '0123456789.'
+
+# Suffixes of the standard metrics reported for every service, in the order
+# format_services writes them.
+SERVICE_METRICS = (
+    'exec_time', 'latency', 'state', 'flapping', 'acknowledged'
+)
+
+# Livestatus queries issued for every scrape.
+STATUS_QUERY = 'GET status'
+SERVICES_QUERY = 'GET services\nColumns: ' + ' '.join(COLUMNS)
+
+# The most recent /metrics lines and the time after which they must be
+# collected again. Only used when --cache_ttl is set.
+_cache = {'lines': None, 'expires': 0}
+# Serializes cache refreshes, so concurrent scrapes that find the cache expired
+# wait for a single collection instead of each querying livestatus.
+_cache_lock = threading.Lock()
+
+# Size of the read buffer for the livestatus socket.
+RECV_SIZE = 64 * 1024
+
+# Canonical command names and metric templates by raw check_command, shared by
+# all scrapes. Services typically share a few dozen distinct check commands, so
+# each is only canonicalized once. The cache is cleared when it reaches
+# COMMAND_CACHE_SIZE entries, e.g. if check arguments embed changing values.
+_command_cache = {}
+COMMAND_CACHE_SIZE = 1024
+
+# Approximate size of the chunks the /metrics response is sent in.
+CHUNK_SIZE = 64 * 1024
+
+# The most recent 'GET status' result and the time after which it must be
+# queried again, as one (status, expires) tuple. Scrapes run in separate
+# threads, so the pair is always read and replaced together. Only used when
+# --status_cache_ttl is set.
+_status_cache = {'entry': (None, 0)}
 
 # Service contains named fields corresponding to the column names returned by
 # the livestatus plugin.
@@ -90,9 +145,8 @@ class NagiosConnectError(NagiosError):
     """Connecting to the livestatus plugin failed."""
 
 
-def parse_args(args):
-    """Parses command line arguments."""
-
+def _build_parser():
+    """Returns the parser for the command line arguments."""
     parser = argparse.ArgumentParser(usage=__doc__)
     parser.add_argument(
         '--path', default='/var/lib/nagios3/rw/livestatus',
@@ -126,6 +180,23 @@ def parse_args(args):
         help=('Writes all metrics to stdout and then exits. Useful for choosing '
               'metrics for whitelist selection.'))
 
+    # Bursts of scrapes, e.g. from several Prometheus servers, can share one
+    # livestatus round trip.
+    parser.add_argument(
+        '--cache_ttl', type=float, default=0, metavar='0',
+        help=('Reuse the /metrics response for up to this many seconds. The '
+              'default, 0, renders a fresh response for every request.'))
+
+    # Nagios status values change slowly compared to service states.
+    parser.add_argument(
+        '--status_cache_ttl', type=float, default=0, metavar='0',
+        help=('Reuse the result of the livestatus status query for up to this '
+              'many seconds. Service metrics are still queried on every '
+              'scrape. Without --whitelist or --all_metrics a cached scrape '
+              'does not connect to livestatus, so nagios_exporter_success '
+              'then only reflects the last real query. The default, 0, '
+              'queries status on every scrape.'))
+
     # Generate metrics from the nagios performance data where available.
     parser.add_argument(
         '--perf_data', dest='use_perf_data', default=False, action='store_true',
@@ -136,7 +207,34 @@ def parse_args(args):
         help=('When parsing performance data, provide specific names to field '
               'positions, e.g. --data_names=check_disk=used;free;;;total'))
 
-    return parser.parse_args(args)
+    return parser
+
+
+def parse_args(args, parser=None):
+    """Parses command line arguments.
+
+    Args:
+      args: list of str, the command line arguments.
+      parser: argparse.ArgumentParser or None, a parser from _build_parser()
+          to reuse. A new parser is built when None.
+
+    Returns:
+      argparse.Namespace, the parsed arguments.
+    """
+    if parser is None:
+        parser = _build_parser()
+    args = parser.parse_args(args)
+    # The data names never change, so parse them once rather than for every
+    # service with performance data.
+    args.perf_data_names = parse_perf_data_fields(args.data_names)
+    # Compile the whitelist patterns once rather than for every metric. Each
+    # is compiled on its own, so inline flags and group references keep
+    # applying to their own pattern only.
+    args.whitelist_patterns = None
+    if args.whitelist:
+        args.whitelist_patterns = [
+            re.compile(pattern) for pattern in args.whitelist]
+    return args
 
 
 def connect(path):
@@ -155,12 +253,17 @@ class LiveStatus(object):
 
     def __init__(self, sock):
         self._sock = sock
+        # The io layer buffers reads in C, so a header and its data, or
+        # several pipelined responses, usually arrive in one recv() call.
+        self._rfile = sock.makefile('rb', RECV_SIZE)
 
     def query(self, query):
         """Queries the livestatus plugin.
 
-        The OutputFormat and ResponseHeader is managed by the LiveStatus
-        class, so do not include these directives in given queries.
+        The OutputFormat, ResponseHeader and KeepAlive headers are managed by
+        the LiveStatus class, so do not include these directives in given
+        queries. Every query uses KeepAlive, so one LiveStatus session may
+        issue several queries over the same connection.
 
         Args:
           query: str, a livestatus query.
@@ -175,27 +278,55 @@ class LiveStatus(object):
         Example queries:
            "GET services\nColumns: host_name"
         """
-        # Extend query to use JSON format and fixed16 header.
-        query += '\nOutputFormat: json\nResponseHeader: fixed16\n'
-        self._send(query)
+        return self.query_all([query])[0]
 
-        # Signal to livestatus that the query is complete.
-        self._sock.shutdown(socket.SHUT_WR)
+    def query_all(self, queries):
+        """Queries the livestatus plugin with several pipelined queries.
 
+        All queries are sent before any response is read. Livestatus answers
+        them in order, so it prepares later responses while earlier ones are
+        still being received and parsed.
+
+        Args:
+          queries: list of str, livestatus queries as accepted by query().
+
+        Returns:
+          list of results, one list of lists per query, in query order.
+
+        Raises:
+          NagiosQueryError: a send error.
+          NagiosResponseError: a receive error.
+        """
+        # Extend each query to use JSON format, fixed16 header and keep the
+        # connection open for later queries. An empty line ends a query.
+        self._send(''.join(
+            query + ('\nOutputFormat: json\nResponseHeader: fixed16'
+                     '\nKeepAlive: on\n\n')
+            for query in queries))
+        return [self._read_response() for _ in queries]
+
+    def _read_response(self):
+        """Reads and parses one livestatus response."""
         # Read the 'fixed16' header: "<status code> <response length>\n"
+        # The code is always three digits and the length is right-justified
+        # in the following eleven characters.
         header = self._receive(16)
+        code = header[:3]
+        length = int(header[4:15])
 
         # For error codes, there is still a message explaining the error.
-        code, length = header.split()
-        length = int(length)
         data = self._receive(length)
 
-        if code == '200':
-            return json.loads(data)
+        # The response is kept as bytes. orjson and ujson parse bytes without
+        # a separate decode pass; the standard json module still decodes the
+        # whole buffer to str internally.
+        if code == b'200':
+            return _json.loads(data)
 
         # Data contains the error message.
         raise NagiosResponseError(
-            'Livestatus error: %s: %s' % (code, data.strip()))
+            'Livestatus error: %s: %s' % (
+                code.decode(), data.strip().decode('utf-8', 'replace')))
 
     def _send(self, msg):
         """Sends the given message to the socket."""
@@ -209,25 +340,21 @@ class LiveStatus(object):
         except socket.error as err:
             raise NagiosQueryError(err)
 
+    def close(self):
+        """Closes the buffered reader and the livestatus socket."""
+        self._rfile.close()
+        self._sock.close()
+
     def _receive(self, count):
-        """Reads data from the livestatus plugin."""
-        results = []
-        while count > 0:
-            try:
-                data = self._sock.recv(count)
-            except socket.error as err:
-                raise NagiosResponseError(err)
-            if len(data) == 0:
-                msg = 'Failed to read data from nagios server.'
-                raise NagiosResponseError(msg)
-            count -= len(data)
-
-            # socket.recv() returns str in Python 2 and bytes in Python 3
-            if sys.version_info[0] >= 3:
-                data = data.decode()
-
-            results.append(data)
-        return ''.join(results)
+        """Reads count bytes from the livestatus plugin."""
+        try:
+            data = self._rfile.read(count)
+        except socket.error as err:
+            raise NagiosResponseError(err)
+        if len(data) < count:
+            msg = 'Failed to read data from nagios server.'
+            raise NagiosResponseError(msg)
+        return data
 
 
 def parse_perf_data_fields(raw_perf_data):
@@ -257,17 +384,18 @@ def parse_perf_data_fields(raw_perf_data):
     """
     fields = {}
     for raw_value in raw_perf_data:
-        values = raw_value.split('=')
-        if len(values) <= 1:
+        # partition() splits once, without building a list of every '=' part.
+        name, separator, values = raw_value.partition('=')
+        if not separator:
             continue
-        name = values[0]
-        values = values[1].split(';')
-        fields[name] = values
+        # Anything after a second '=' is ignored.
+        if '=' in values:
+            values = values[:values.index('=')]
+        fields[name] = values.split(';')
     return fields
 
 
-def get_perf_data(check_command, metric_labels, raw_perf_data_values,
-                  raw_perf_data_names):
+def get_perf_data(check_command, raw_perf_data_values, perf_data_names):
     """Parses raw performance data from nagios plugins.
 
     Performance data is a set of key=value1[;value2]... data. For example:
@@ -282,7 +410,7 @@ def get_perf_data(check_command, metric_labels, raw_perf_data_values,
         check_disk_perf_data_value {key="/", ...} 2516582400
 
     More specific names can be assigned to each value position through
-    raw_perf_data_names. For example:
+    perf_data_names, as parsed from --data_names flags. For example:
 
         check_disks=used;free;;;total
 
@@ -297,71 +425,75 @@ def get_perf_data(check_command, metric_labels, raw_perf_data_values,
     Args:
       check_command: str, the metric name prefix, used to create metric names
           for performance data.
-      metric_labels: dict of str, key value labels to apply resulting metrics.
       raw_perf_data_values: iterable of str, the performance data as collected
           by Nagios from the check plugins.
-      raw_perf_data_names: iterable of str, each element should match the
-          pattern: <check_command>=<0-name>[;<1-name>]*. This names perf_data
-          values for the given check_command. The default field name is simply
+      perf_data_names: dict of str to list of str, as returned by
+          parse_perf_data_fields() for flags matching the pattern:
+          <check_command>=<0-name>[;<1-name>]*. This names perf_data values
+          for the given check_command. The default field name is simply
           'value'.
 
     Returns:
-      list of (suffix, labels, value) tuples.
+      list of (name, key, value) tuples, where key is the performance data
+      key to use as the 'key' label.
     """
     metrics = []
 
     values_map = parse_perf_data_fields(raw_perf_data_values)
-    names_map = parse_perf_data_fields(raw_perf_data_names)
 
-    for key, raw_values in values_map.items():
-        labels = {'key': key}
-        labels.update(metric_labels)
+    # Use given field names, or default to use the first value only. The
+    # metric names only depend on the command, so build them once for all keys.
+    field_names = perf_data_names.get(check_command, ('value',))
+    fields = [(i, metric_name(check_command + '_perf_data_' + field_name))
+              for i, field_name in enumerate(field_names) if field_name]
 
+    for key, raw_values in values_map.items():
         # NOTE: Units are typically only noted on the first value, so save it.
         _, unit = parse_value_and_unit(raw_values[0])
 
-        # Use given field names, or default to use the first value only.
-        field_names = names_map.get(check_command, ('value',))
-
         # Convert every perf_data value for which we have a field name.
-        for i, field_name in enumerate(field_names):
-            if not field_name:
-                continue
-
+        for i, name in fields:
             value, _ = parse_value_and_unit(raw_values[i])
             base_value = convert_value_to_base_unit(value, unit)
-            suffix = '_' + field_name
-            metrics.append(
-                (check_command + '_perf_data' + suffix, labels, base_value))
+            metrics.append((name, key, base_value))
 
     return metrics
 
 
 def parse_value_and_unit(raw_value):
     """Returns the value, unit tuple. Unit may be empty."""
-    m = UNIT_REGEX.match(raw_value)
-    if not m:
+    # str.lstrip scans in C and avoids allocating a regex match object.
+    unit = raw_value.lstrip(VALUE_CHARS)
+    if not unit:
+        # Most perf data values are plain numbers.
         return raw_value, ''
-    value, unit = m.groups('')
-    return value, unit
+    value_len = len(raw_value) - len(unit)
+    if not value_len:
+        return raw_value, ''
+    # The unit ends at the next value character, if any.
+    for i, c in enumerate(unit):
+        if c in VALUE_CHARS:
+            unit = unit[:i]
+            break
+    return raw_value[:value_len], unit
 
 
 def convert_value_to_base_unit(value, unit):
     """Converts value to canonical units."""
-    if not unit:
-        return value
-
-    if unit not in UNIT_TO_SCALE:
-        logging.warning('Unknown unit: %s', unit)
+    # A single lookup covers both the empty and the unknown unit.
+    scale = UNIT_TO_SCALE.get(unit)
+    if scale is None:
+        # Warn only once per unit rather than for every value on every scrape.
+        if unit and unit not in _unknown_units:
+            _unknown_units.add(unit)
+            logging.warning('Unknown unit: %s', unit)
         return value
 
     try:
-        value = float(value)
-        value *= UNIT_TO_SCALE[unit]
+        return str(float(value) * scale)
     except ValueError:
         # Leave value as-is to be handled by format_metric().
         return value + unit
-    return str(value)
 
 
 def canonical_command(cmd):
@@ -378,132 +510,271 @@ def canonical_command(cmd):
         return fields[0]
 
 
-def format_labels(labels):
-    """Formats key=values to a prometheus label format."""
-    if not labels:
-        return ''
+def metric_name(name):
+    """Replaces characters that are not valid in prometheus metric names."""
+    return name.replace('-', '_').replace('.', '_')
 
-    fields = []
-    for key, value in sorted(labels.items()):
-        fields.append('%s="%s"' % (key, value))
 
-    return '{' + ', '.join(fields) + '}'
+def escape_label_value(value):
+    """Escapes the characters that are special in prometheus label values."""
+    # Most values contain none of these characters; the membership tests are
+    # cheaper than three replace calls that copy the string each time.
+    if '\\' in value:
+        value = value.replace('\\', '\\\\')
+    if '"' in value:
+        value = value.replace('"', '\\"')
+    if '\n' in value:
+        value = value.replace('\n', '\\n')
+    return value
 
 
 def format_metric(name, labels, value):
-    """Formats the prometheus metric."""
+    """Formats the prometheus metric.
+
+    Args:
+      name: str, the metric name without the 'nagios_' prefix, as returned
+          by metric_name().
+      labels: str, preformatted labels sorted by name, without braces, e.g.
+          'hostname="localhost", service="Load"'. May be empty.
+      value: the metric value.
+
+    Returns:
+      str, the metric in prometheus text format.
+    """
     try:
         float(value)
     except ValueError:
         # Convert the value (which is not a number) to a label. And use a
-        # constant value of 1 instead.
-        labels = labels.copy()
-        labels['value'] = value
+        # constant value of 1 instead. The 'value' label sorts after every
+        # label used by this exporter, so it is appended last.
+        if labels:
+            labels += ', '
+        labels += 'value="%s"' % escape_label_value(value)
         value = 1
-    return 'nagios_%s%s %s' % (
-        name.replace('-', '_').replace('.','_'), format_labels(labels), value)
+    if labels:
+        labels = '{' + labels + '}'
+    return 'nagios_%s%s %s' % (name, labels, value)
 
 
-def get_status(session):
-    """Queries the livestatus plugin and exports status metrics about nagios."""
-    query = 'GET status'
-    status = session.query(query)
-    values = dict(zip(status[0], status[1]))
-
+def format_status(status):
+    """Exports status metrics about nagios from a 'GET status' result."""
+    # The first row holds the column names and the second their values.
     lines = []
-    for key, value in values.items():
-        lines.append(format_metric(key, {}, value))
+    for key, value in zip(status[0], status[1]):
+        lines.append(format_metric(metric_name(key), '', value))
 
     return lines
 
 
-def get_services(session, use_perf_data, raw_perf_data_names):
-    """Queries the livestatus plugin and exports service metrics."""
-    query = 'GET services\nColumns: ' + ' '.join(COLUMNS)
-    services = [Service(*s) for s in session.query(query)]
+def service_templates(cmd):
+    """Returns the format templates of the standard metrics for cmd.
+
+    Each template only needs the formatted labels and the value, e.g.
+    'nagios_check_load_state%s %s', so the metric name is built once per
+    command rather than once per service.
+    """
+    name = metric_name(cmd).replace('%', '%%')
+    return tuple('nagios_%s_%s%%s %%s' % (name, suffix)
+                 for suffix in SERVICE_METRICS)
 
-    lines = []
-    for s in services:
-        # Standard labels.
-        labels = {'hostname': s.host_name, 'service': s.service_description}
 
-        cmd = canonical_command(s.check_command)
+def format_services(services, use_perf_data, perf_data_names,
+                    whitelist=None):
+    """Exports service metrics from a SERVICES_QUERY result.
+
+    Args:
+      services: list of lists, the service rows in COLUMNS order.
+      use_perf_data: bool, whether to export performance data metrics.
+      perf_data_names: dict of str to list of str, the parsed --data_names.
+      whitelist: list of compiled regex or None. When given, only metrics
+          matching any of them are returned.
+
+    Returns:
+      list of str, the metric lines.
+    """
+    lines = []
+    if whitelist is None:
+        add = lines.append
+    else:
+        # Filter each metric as it is formatted, so metrics that are dropped
+        # are never held in a list of every service metric.
+        searches = [pattern.search for pattern in whitelist]
+
+        def add_matching(line):
+            # Each metric is reported once, however many patterns match it.
+            if any(search(line) for search in searches):
+                lines.append(line)
+        add = add_matching
+
+    commands = _command_cache
+    # Unpack each row once, in COLUMNS order, as the rows are visited in
+    # sequence.
+    for (hostname, service, state, latency, perf_data, check_command,
+         acknowledged, execution_time, is_flapping) in services:
+        # Standard labels. All standard metrics of a service share them, so
+        # format them once, directly in sorted order.
+        hostname = escape_label_value(hostname)
+        service = escape_label_value(service)
+        label_str = '{hostname="%s", service="%s"}' % (hostname, service)
+
+        names = commands.get(check_command)
+        if names is None:
+            if len(commands) >= COMMAND_CACHE_SIZE:
+                commands.clear()
+            cmd = canonical_command(check_command)
+            names = cmd, service_templates(cmd)
+            commands[check_command] = names
+        cmd, (exec_time_fmt, latency_fmt, state_fmt, flapping_fmt,
+              acknowledged_fmt) = names
+        # Livestatus reports these columns as numbers, so they can skip the
+        # value checks in format_metric().
         # TODO: use a single histogram for all execution and latency times.
-        lines.append(
-            format_metric('%s_exec_time' % cmd, labels, s.execution_time))
-        lines.append(
-            format_metric('%s_latency' % cmd, labels, s.latency))
-        lines.append(
-            format_metric('%s_state' % cmd, labels, s.state))
-        lines.append(
-            format_metric('%s_flapping' % cmd, labels, s.is_flapping))
-        lines.append(
-            format_metric('%s_acknowledged' % cmd, labels, s.acknowledged))
-
-        if use_perf_data and s.perf_data:
-            values = get_perf_data(
-                cmd, labels, s.perf_data.split(), raw_perf_data_names)
-            for (perf_metric, perf_labels, value) in values:
-                lines.append(format_metric(perf_metric, perf_labels, value))
+        add(exec_time_fmt % (label_str, execution_time))
+        add(latency_fmt % (label_str, latency))
+        add(state_fmt % (label_str, state))
+        add(flapping_fmt % (label_str, is_flapping))
+        add(acknowledged_fmt % (label_str, acknowledged))
+
+        if use_perf_data and perf_data:
+            values = get_perf_data(cmd, perf_data.split(), perf_data_names)
+            # Only the key label differs between perf data metrics, so format
+            # the labels around it once per service.
+            labels_before_key = 'hostname="%s", key="' % hostname
+            labels_after_key = '", service="%s"' % service
+            for (perf_metric, key, value) in values:
+                perf_labels = (labels_before_key + escape_label_value(key) +
+                               labels_after_key)
+                add(format_metric(perf_metric, perf_labels, value))
 
     return lines
 
 
 def collect_metrics(args, lines):
-    """Generates metric data as a flask.Response."""
+    """Appends status and service metric lines from livestatus to lines."""
     if not os.path.exists(args.path):
         lines.append('# livestatus socket does not exist! %s' % args.path)
         lines.append('nagios_livestatus_available 0')
         return
 
     lines.append('nagios_livestatus_available 1')
-    with contextlib.closing(connect(args.path)) as sock:
-        session = LiveStatus(sock)
-        lines.extend(get_status(session))
-
-    if args.whitelist or args.all_metrics or args.dump_metrics:
-        with contextlib.closing(connect(args.path)) as sock:
-            session = LiveStatus(sock)
-            services = get_services(
-                session, args.use_perf_data, args.data_names)
-
-        if args.whitelist:
-            for metric in services:
-                for whitelist in args.whitelist:
-                    metric_match = re.search(whitelist, metric)
-                    if metric_match:
-                        lines.append(metric)
-
-        else:
-            lines.extend(services)
+    now = time.time()
+    status, expires = _status_cache['entry']
+    query_status = not args.status_cache_ttl or now >= expires
+    query_services = args.whitelist or args.all_metrics or args.dump_metrics
+
+    queries = []
+    if query_status:
+        queries.append(STATUS_QUERY)
+    if query_services:
+        queries.append(SERVICES_QUERY)
+
+    results = []
+    # With only a cached status to report there is nothing to query, so
+    # livestatus is not contacted and its health is not checked this scrape.
+    if queries:
+        # Both queries share one connection and are sent together, so
+        # livestatus collects the services while the status response is read.
+        with contextlib.closing(LiveStatus(connect(args.path))) as session:
+            results = session.query_all(queries)
+
+    if query_status:
+        status = results.pop(0)
+        if args.status_cache_ttl:
+            _status_cache['entry'] = (status, now + args.status_cache_ttl)
+
+    lines.extend(format_status(status))
+    if query_services:
+        lines.extend(format_services(
+            results[0], args.use_perf_data, args.perf_data_names,
+            args.whitelist_patterns))
 
     return
 
 
-def metrics(args):
-    """Handles requests for /metrics."""
+def scrape(args):
+    """Collects all metrics for one /metrics response.
+
+    Returns:
+      list of str, the metric lines, ending with nagios_exporter_success.
+    """
     lines = []
     try:
         collect_metrics(args, lines)
         lines.append('nagios_exporter_success 1')
     except NagiosError:
         lines.append('nagios_exporter_success 0')
+    return lines
+
+
+def encode_lines(lines):
+    """Yields lines as newline terminated, UTF-8 encoded chunks.
+
+    Lines are encoded into chunks of about CHUNK_SIZE bytes as the response is
+    sent, so the full response body never exists as one string or buffer.
+    """
+    # Join and encode each chunk's lines in one call rather than encoding and
+    # appending every line on its own. The sizes count characters, which is
+    # close enough for this purpose.
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line) + 1
+        if size >= CHUNK_SIZE:
+            # The last line must include a new line or the prometheus parser
+            # fails.
+            chunk.append('')
+            yield '\n'.join(chunk).encode('utf-8')
+            chunk = []
+            size = 0
+    if chunk:
+        chunk.append('')
+        yield '\n'.join(chunk).encode('utf-8')
+
+
+def metrics(args):
+    """Handles requests for /metrics."""
+    if not args.cache_ttl:
+        lines = scrape(args)
+    else:
+        with _cache_lock:
+            now = time.time()
+            if now >= _cache['expires']:
+                _cache['lines'] = scrape(args)
+                _cache['expires'] = now + args.cache_ttl
+            lines = _cache['lines']
+
+    return wrappers.Response(
+        encode_lines(lines), content_type='text/plain; charset=utf-8')
+
+
+def make_app(args):
+    """Returns a WSGI application that serves /metrics."""
+    # The exporter has a single route, so a plain WSGI callable avoids the
+    # per-request overhead of a web framework's routing and request context.
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            response = exceptions.NotFound()
+        elif environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            response = exceptions.MethodNotAllowed(['GET', 'HEAD'])
+        else:
+            response = metrics(args)
+        return response(environ, start_response)
 
-    # The last line must include a new line or the prometheus parser fails.
-    response = '\n'.join(lines) + '\n'
-    return flask.Response(response, content_type='text/plain; charset=utf-8')
+    return app
 
 
 def main():  # pragma: no cover
     args = parse_args(sys.argv[1:])
     if args.dump_metrics:
         resp = metrics(args)
-        sys.stdout.write(resp.get_data())
+        # Write the encoded bytes; on Python 3 they go to the underlying
+        # binary stream.
+        getattr(sys.stdout, 'buffer', sys.stdout).write(resp.get_data())
         sys.exit(0)
 
-    app = flask.Flask(__name__)
-    app.add_url_rule('/metrics', 'metrics', lambda: metrics(args))
-    app.run(host=args.host, port=args.port, debug=False)
+    # Serve concurrent scrapes from separate threads rather than one by one.
+    serving.run_simple(args.host, args.port, make_app(args), threaded=True)
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -2,27 +2,51 @@
 
 import contextlib
 import io
+import itertools
 import json
-import mock
 import os
+import re
 import socket
 import textwrap
+import threading
+import time
 import unittest
-import sys
-from collections import OrderedDict
+
+# mock is part of unittest on Python 3; the backport is only needed on
+# Python 2.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from werkzeug import test as werkzeug_test
 
 import nagios_exporter
 
 
+# Like a real socket, FakeSocketIO.recv returns at most this many bytes per
+# call, however many were requested.
+RECV_CHUNK = 4096
+
+
 class FakeSocketIO(object):
     """An in-memory, socket-like object for unit tests."""
 
+    __slots__ = ('_write_chunks', '_reader', '_offset')
+
     def __init__(self, initial_value=''):
-        if sys.version_info[0] >= 3:
+        if not isinstance(initial_value, bytes):
             initial_value = initial_value.encode()
 
-        self._writer = io.BytesIO()
-        self._reader = io.BytesIO(initial_value)
+        self._write_chunks = []
+        # recv slices the requested bytes straight out of the response.
+        self._reader = memoryview(initial_value)
+        self._offset = 0
+
+    @classmethod
+    def from_livestatus_payload(cls, code, body):
+        """Creates a socket that returns body as one livestatus response."""
+        return cls(wire(body, code))
 
     def shutdown(self, unused_path):
         pass
@@ -31,64 +55,228 @@ class FakeSocketIO(object):
         pass
 
     def recv(self, count=-1):
-        """Reads count bytes from socket, or until EOF when count is -1."""
-        return self._reader.read(count)
+        """Reads up to count bytes from socket, at most RECV_CHUNK at a time.
+
+        When count is -1, reads until EOF.
+        """
+        start = self._offset
+        end = len(self._reader)
+        if count != -1:
+            end = min(start + min(count, RECV_CHUNK), end)
+        self._offset = end
+        return self._reader[start:end].tobytes()
+
+    def makefile(self, unused_mode, bufsize):
+        """Returns a buffered reader over recv, as socket.makefile does."""
+        return io.BufferedReader(_SocketReader(self), bufsize)
 
     def sendall(self, message):
         """Writes message to socket."""
-        return self._writer.write(message)
+        self._write_chunks.append(message)
+
+    def getvalue(self):
+        """Returns all bytes written to socket."""
+        return b''.join(self._write_chunks)
+
+
+class _SocketReader(io.RawIOBase):
+    """A raw stream that reads from a socket-like object with recv."""
+
+    def __init__(self, sock):
+        super(_SocketReader, self).__init__()
+        self._sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self._sock.recv(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+class ErrorInjectingFakeSocketIO(FakeSocketIO):
+    """A FakeSocketIO whose recv or sendall raise socket.error."""
+
+    __slots__ = ('_raise_on',)
+
+    def __init__(self, initial_value='', raise_on=()):
+        """Creates the socket.
+
+        Args:
+          initial_value: str or bytes, the data available to recv.
+          raise_on: iterable of str, the methods that raise, from 'recv' and
+              'sendall'.
+        """
+        super(ErrorInjectingFakeSocketIO, self).__init__(initial_value)
+        self._raise_on = frozenset(raise_on)
+
+    def recv(self, count=-1):
+        if 'recv' in self._raise_on:
+            raise socket.error('fake socket error')
+        return super(ErrorInjectingFakeSocketIO, self).recv(count)
+
+    def sendall(self, message):
+        if 'sendall' in self._raise_on:
+            raise socket.error('fake socket error')
+        return super(ErrorInjectingFakeSocketIO, self).sendall(message)
+
+
+# Building the argument parser costs far more than parsing, so the tests share
+# one parser.
+_PARSER = nagios_exporter._build_parser()
+
+
+def parse_args(args):
+    """Parses command line arguments with the shared parser."""
+    return nagios_exporter.parse_args(args, _PARSER)
+
+
+# The regex parse_value_and_unit used to be built on, as an oracle for it.
+_VALUE_AND_UNIT_ORACLE = re.compile('([0-9.]+)([^0-9.]+)?')
+
+
+def oracle_value_and_unit(raw_value):
+    """Returns the value, unit tuple as the original regex parsed it."""
+    m = _VALUE_AND_UNIT_ORACLE.match(raw_value)
+    if not m:
+        return raw_value, ''
+    return m.groups('')
+
+
+# Headers already created by fixed16, by code and length.
+_fixed16_headers = {}
 
 
 def fixed16(code, length):
     """Creates a fixed16 header."""
-    return "%s %11d\n" % (code, length)
+    # functools.lru_cache is not available on Python 2.
+    header = _fixed16_headers.get((code, length))
+    if header is None:
+        header = "%s %11d\n" % (code, length)
+        _fixed16_headers[(code, length)] = header
+    return header
+
+
+def wire(body, code='200'):
+    """Returns the livestatus response for body, framed by a fixed16 header."""
+    if not isinstance(body, bytes):
+        body = body.encode()
+    return fixed16(code, len(body)).encode() + body
+
+
+# A sample service record. Tests only read it; livestatus returns each row as
+# a list, which json.dumps also produces from the namedtuple.
+_SERVICES = (
+    nagios_exporter.Service(
+        host_name='localhost',
+        service_description='Current Load',
+        state=0,
+        latency=0.078,
+        perf_data='load1=0.560;5.000;10.000;0;',
+        check_command='check_load!5.0!4.0!3.0!10.0!6.0!4.0',
+        acknowledged=0,
+        execution_time=0.011084,
+        is_flapping=0
+    ),
+)
+
+# Livestatus responses, built once as bytes for every test that needs them.
+_SERVICES_WIRE = wire(json.dumps(_SERVICES))
+_STATUS_WIRE = wire(json.dumps([['thing_a', 'thing_b'], [1, 0]]))
+_STATUS_A_WIRE = wire(json.dumps([['thing_a'], [1]]))
+
+# The metrics for _STATUS_WIRE, after the livestatus availability.
+_EXPECTED_STATUS = (
+    'nagios_livestatus_available 1',
+    'nagios_thing_a 1',
+    'nagios_thing_b 0',
+)
+# The standard metrics for _SERVICES.
+_EXPECTED_SERVICES_BASE = (
+    'nagios_check_load_exec_time{hostname="localhost", service="Current Load"} 0.011084',
+    'nagios_check_load_latency{hostname="localhost", service="Current Load"} 0.078',
+    'nagios_check_load_state{hostname="localhost", service="Current Load"} 0',
+    'nagios_check_load_flapping{hostname="localhost", service="Current Load"} 0',
+    'nagios_check_load_acknowledged{hostname="localhost", service="Current Load"} 0',
+)
+_EXPECTED_SERVICES_WITH_PERF = _EXPECTED_SERVICES_BASE + (
+    'nagios_check_load_perf_data_value{hostname="localhost", key="load1", service="Current Load"} 0.560',
+)
 
 
 class NagiosExporterTest(unittest.TestCase):
 
-    def setUp(self):
-        # A sample service record.
-        self.services = [
-            list(nagios_exporter.Service(
-                host_name='localhost',
-                service_description='Current Load',
-                state=0,
-                latency=0.078,
-                process_performance_data=1,
-                perf_data='load1=0.560;5.000;10.000;0;',
-                check_command='check_load!5.0!4.0!3.0!10.0!6.0!4.0',
-                acknowledged=0,
-                execution_time=0.011084,
-                is_flapping=0
-            ))
-        ]
-
-    def assertItemsEqual(self, *args, **kwargs):
-        # In Python 3, assertItemsEqual is named assertCountEqual
-        # https://hg.python.org/cpython/rev/d9921cb6e3cd
-        if sys.version_info[0] >= 3:
-            return super(NagiosExporterTest, self).assertCountEqual(*args, **kwargs)
+    @contextlib.contextmanager
+    def subTest(self, **params):
+        # subTest is new in Python 3.4. On Python 2 the cases simply run in
+        # sequence, and the first failure ends the test.
+        if hasattr(unittest.TestCase, 'subTest'):
+            with super(NagiosExporterTest, self).subTest(**params):
+                yield
         else:
-            return super(NagiosExporterTest, self).assertItemsEqual(*args, **kwargs)
+            yield
 
     def test_canonical_command_with_nrpe(self):
         actual = nagios_exporter.canonical_command('check_nrpe2!check_node')
 
         self.assertEqual(actual, 'check_node')
 
+    def test_service_templates(self):
+        actual = nagios_exporter.service_templates('check-100%.x')
+
+        self.assertEqual(actual[0], 'nagios_check_100%%_x_exec_time%s %s')
+        self.assertEqual(
+            actual[2] % ('{a="b"}', 0), 'nagios_check_100%_x_state{a="b"} 0')
+
     def test_connect_when_connection_fails(self):
         with self.assertRaises(nagios_exporter.NagiosConnectError):
             session = nagios_exporter.connect('/not-a-real-path')
 
     def test_livestatus_query(self):
-        json_response = json.dumps(self.services)
-        fixed16_header = fixed16('200', len(json_response))
-        fake_sock = FakeSocketIO(fixed16_header + json_response)
+        fake_sock = FakeSocketIO(_SERVICES_WIRE)
 
         session = nagios_exporter.LiveStatus(fake_sock)
         actual = session.query('blah')
 
-        self.assertEqual(actual, self.services)
+        self.assertEqual(actual, [list(row) for row in _SERVICES])
+        self.assertEqual(
+            fake_sock.getvalue(),
+            b'blah\nOutputFormat: json\nResponseHeader: fixed16\n'
+            b'KeepAlive: on\n\n')
+
+    def test_livestatus_query_all(self):
+        fake_sock = FakeSocketIO(_STATUS_A_WIRE + _SERVICES_WIRE)
+
+        session = nagios_exporter.LiveStatus(fake_sock)
+        actual = session.query_all(['GET status', 'GET services'])
+
+        self.assertEqual(
+            actual, [[['thing_a'], [1]], [list(row) for row in _SERVICES]])
+        # Both queries are sent together, ahead of reading any response.
+        self.assertEqual(
+            fake_sock.getvalue(),
+            b'GET status\nOutputFormat: json\nResponseHeader: fixed16\n'
+            b'KeepAlive: on\n\n'
+            b'GET services\nOutputFormat: json\nResponseHeader: fixed16\n'
+            b'KeepAlive: on\n\n')
+
+    def test_livestatus_query_with_short_reads(self):
+        services = _SERVICES * 100
+        json_response = json.dumps(services)
+        # The response needs several recv calls.
+        self.assertGreater(len(json_response), 2 * RECV_CHUNK)
+        fake_sock = FakeSocketIO.from_livestatus_payload('200', json_response)
+
+        session = nagios_exporter.LiveStatus(fake_sock)
+        with mock.patch.object(
+                FakeSocketIO, 'recv', autospec=True,
+                side_effect=FakeSocketIO.recv) as mock_recv:
+            actual = session.query('blah')
+
+        self.assertEqual(actual, [list(row) for row in services])
+        # The buffered reader of LiveStatus assembled the short reads.
+        self.assertGreater(mock_recv.call_count, 2)
 
     def test_livestatus_query_when_recv_response_is_empty(self):
         with self.assertRaises(nagios_exporter.NagiosResponseError):
@@ -98,15 +286,10 @@ class NagiosExporterTest(unittest.TestCase):
             session.query('blah')
 
     def test_livestatus_query_when_recv_raises_exception(self):
-        class FakeSocketIOWithError(FakeSocketIO):
-            """Subclass of FakeSocketIO that raises an exception on sendall"""
-
-            def recv(self, count):
-                raise socket.error('fake socket error')
-
         with self.assertRaises(nagios_exporter.NagiosResponseError):
             # Expect 10 bytes that are never sent.
-            fake_sock = FakeSocketIOWithError(fixed16('400', 10))
+            fake_sock = ErrorInjectingFakeSocketIO(
+                fixed16('400', 10), raise_on=['recv'])
 
             session = nagios_exporter.LiveStatus(fake_sock)
             session.query('blah')
@@ -115,163 +298,225 @@ class NagiosExporterTest(unittest.TestCase):
         with self.assertRaises(nagios_exporter.NagiosResponseError):
             # Expect 10 bytes that are never sent.
             message = 'error message'
-            fake_sock = FakeSocketIO(fixed16('400', len(message)) + message)
+            fake_sock = FakeSocketIO.from_livestatus_payload('400', message)
 
             session = nagios_exporter.LiveStatus(fake_sock)
             session.query('blah')
 
     def test_livestatus_query_when_sendall_raises_exception(self):
-        class FakeSocketIOWithError(FakeSocketIO):
-            """Subclass of FakeSocketIO that raises an exception on sendall"""
-
-            def sendall(self, msg):
-                raise socket.error('fake socket error')
-
         with self.assertRaises(nagios_exporter.NagiosQueryError):
             # Text is never used.
-            fake_sock = FakeSocketIOWithError('')
+            fake_sock = ErrorInjectingFakeSocketIO('', raise_on=['sendall'])
 
             session = nagios_exporter.LiveStatus(fake_sock)
             session.query('blah')
 
-    def test_get_services(self):
-        expected = [
-            'nagios_check_load_exec_time{hostname="localhost", service="Current Load"} 0.011084',
+    @mock.patch.dict(nagios_exporter._command_cache, clear=True)
+    def test_format_services(self):
+        actual = nagios_exporter.format_services(_SERVICES, False, {})
+
+        self.assertEqual(actual, list(_EXPECTED_SERVICES_BASE))
+
+    @mock.patch.dict(nagios_exporter._command_cache, clear=True)
+    def test_format_services_with_inline_flag_whitelist(self):
+        args = parse_args(['--whitelist=(?i)LOAD_STATE', '--whitelist=_Latency'])
+
+        actual = nagios_exporter.format_services(
+            _SERVICES, False, {}, args.whitelist_patterns)
+
+        # The inline flag only applies to its own pattern.
+        self.assertEqual(actual, [
+            'nagios_check_load_state{hostname="localhost", service="Current Load"} 0',
+        ])
+
+    @mock.patch.dict(nagios_exporter._command_cache, clear=True)
+    def test_format_services_with_data_names_for_sanitized_command(self):
+        service = list(_SERVICES[0])
+        service[nagios_exporter.COLUMNS.index('check_command')] = 'check-disk.v2!/'
+        service[nagios_exporter.COLUMNS.index('perf_data')] = '/=10MB;20'
+
+        actual = nagios_exporter.format_services(
+            [service], True, {'check-disk.v2': ['used', 'free']})
+
+        # Data names are given for the raw command, while metric names use
+        # the sanitized one.
+        self.assertEqual(actual[5:], [
+            'nagios_check_disk_v2_perf_data_used{hostname="localhost", key="/", service="Current Load"} 10485760.0',
+            'nagios_check_disk_v2_perf_data_free{hostname="localhost", key="/", service="Current Load"} 20971520.0',
+        ])
+
+    @mock.patch.dict(nagios_exporter._command_cache, clear=True)
+    def test_format_services_escapes_label_values(self):
+        service = list(_SERVICES[0])
+        service[nagios_exporter.COLUMNS.index('service_description')] = (
+            'Disk "C:\\"\n')
+
+        actual = nagios_exporter.format_services([service], False, {})
+
+        self.assertEqual(
+            actual[0],
+            'nagios_check_load_exec_time{hostname="localhost", '
+            'service="Disk \\"C:\\\\\\"\\n"} 0.011084')
+
+    @mock.patch.dict(nagios_exporter._command_cache, clear=True)
+    def test_format_services_with_whitelist(self):
+        whitelist = [re.compile('_state|_latency')]
+
+        actual = nagios_exporter.format_services(
+            _SERVICES, False, {}, whitelist)
+
+        self.assertEqual(actual, [
             'nagios_check_load_latency{hostname="localhost", service="Current Load"} 0.078',
             'nagios_check_load_state{hostname="localhost", service="Current Load"} 0',
-            'nagios_check_load_flapping{hostname="localhost", service="Current Load"} 0',
-            'nagios_check_load_acknowledged{hostname="localhost", service="Current Load"} 0'
-        ]
-        json_response = json.dumps(self.services)
-        fixed16_header = fixed16('200', len(json_response))
-        fake_sock = FakeSocketIO(fixed16_header + json_response)
+        ])
 
-        session = nagios_exporter.LiveStatus(fake_sock)
-        actual = nagios_exporter.get_services(session, False, ())
+    @mock.patch.object(nagios_exporter, 'COMMAND_CACHE_SIZE', 1)
+    @mock.patch.dict(nagios_exporter._command_cache, clear=True)
+    def test_format_services_bounds_command_cache(self):
+        other = list(_SERVICES[0])
+        other[nagios_exporter.COLUMNS.index('check_command')] = 'check_other'
 
-        self.assertEqual(actual, expected)
+        nagios_exporter.format_services(_SERVICES + (other,), False, {})
 
-    def test_get_status(self):
+        self.assertEqual(list(nagios_exporter._command_cache), ['check_other'])
+
+    def test_format_status(self):
         expected = [
             'nagios_thing_a 1',
             'nagios_thing_b 0'
         ]
-        json_response = json.dumps([['thing_a', 'thing_b'], [1, 0]])
-        fixed16_header = fixed16('200', len(json_response))
-        fake_sock = FakeSocketIO(fixed16_header + json_response)
 
-        session = nagios_exporter.LiveStatus(fake_sock)
-        actual = nagios_exporter.get_status(session)
+        actual = nagios_exporter.format_status([['thing_a', 'thing_b'], [1, 0]])
 
-        self.assertItemsEqual(actual, expected)
+        # Metrics follow the column order of the status response.
+        self.assertEqual(actual, expected)
 
     def test_parse_args(self):
         args = nagios_exporter.parse_args(['--path', '/some/path'])
 
         self.assertEqual(args.path, '/some/path')
 
+    def test_parse_args_parses_data_names(self):
+        args = parse_args(
+            ['--data_names=check_disk=used;free', '--data_names=check_x=a'])
+
+        self.assertEqual(
+            args.perf_data_names,
+            {'check_disk': ['used', 'free'], 'check_x': ['a']})
+
     def test_collect_metrics_with_bad_path(self):
-        args = nagios_exporter.parse_args(['--path', '/not-a-real/path'])
+        args = parse_args(['--path', '/not-a-real/path'])
 
         lines = []
         nagios_exporter.collect_metrics(args, lines)
 
         self.assertIn('nagios_livestatus_available 0', lines)
 
+    def test_escape_label_value(self):
+        self.assertEqual(nagios_exporter.escape_label_value('plain'), 'plain')
+        self.assertEqual(
+            nagios_exporter.escape_label_value('a\\b"c\nd'),
+            'a\\\\b\\"c\\nd')
+
     def test_format_metric_with_various_value_types(self):
       # Integer.
       self.assertEqual(
           'nagios_check_cmd{key="/"} 1',
-          nagios_exporter.format_metric('check_cmd', {'key': '/'}, '1'))
+          nagios_exporter.format_metric('check_cmd', 'key="/"', '1'))
       # Float.
       self.assertEqual(
           'nagios_check_cmd{key="/"} 0.1',
-          nagios_exporter.format_metric('check_cmd', {'key': '/'}, '0.1'))
+          nagios_exporter.format_metric('check_cmd', 'key="/"', '0.1'))
       # String.
       self.assertEqual(
           'nagios_check_cmd{key="/", value="v0.1"} 1',
-          nagios_exporter.format_metric('check_cmd', OrderedDict({'key': '/'}), 'v0.1'))
+          nagios_exporter.format_metric('check_cmd', 'key="/"', 'v0.1'))
+      # No labels.
+      self.assertEqual(
+          'nagios_check_cmd 1',
+          nagios_exporter.format_metric('check_cmd', '', '1'))
+      self.assertEqual(
+          'nagios_check_cmd{value="v0.1"} 1',
+          nagios_exporter.format_metric('check_cmd', '', 'v0.1'))
 
     @mock.patch.object(nagios_exporter, 'collect_metrics')
     def test_metrics_when_exception_is_raised(self, mock_metrics):
         mock_metrics.side_effect = nagios_exporter.NagiosResponseError('error')
 
-        actual = nagios_exporter.metrics(())
+        args = parse_args([])
+        actual = nagios_exporter.metrics(args)
 
         self.assertEqual(actual.status, '200 OK')
         self.assertEqual(actual.get_data(as_text=True), 'nagios_exporter_success 0\n')
 
     @mock.patch.object(nagios_exporter, 'collect_metrics')
     def test_metrics(self, mock_metrics):
-        actual = nagios_exporter.metrics(())
+        args = parse_args([])
+        actual = nagios_exporter.metrics(args)
 
         self.assertEqual(actual.status, '200 OK')
         self.assertEqual(actual.get_data(as_text=True), 'nagios_exporter_success 1\n')
 
-    @mock.patch.object(nagios_exporter, 'connect')
-    @mock.patch.object(os.path, 'exists')
-    def test_collect_metrics_when_all_metrics_is_true(
-        self, mock_exists, mock_connect):
-        args = nagios_exporter.parse_args(
-            ['--path', '/not-a-real/path', '--all_metrics', '--perf_data'])
-        expected_status = [
-            'nagios_livestatus_available 1',
-            'nagios_thing_a 1',
-            'nagios_thing_b 0'
-        ]
-        # Setup fake get_status response.
-        json_response = json.dumps([['thing_a', 'thing_b'], [1, 0]])
-        fixed16_header = fixed16('200', len(json_response))
-        fake_status_sock = FakeSocketIO(fixed16_header + json_response)
-        expected_services = [
-            'nagios_check_load_exec_time{hostname="localhost", service="Current Load"} 0.011084',
-            'nagios_check_load_latency{hostname="localhost", service="Current Load"} 0.078',
-            'nagios_check_load_state{hostname="localhost", service="Current Load"} 0',
-            'nagios_check_load_flapping{hostname="localhost", service="Current Load"} 0',
-            'nagios_check_load_acknowledged{hostname="localhost", service="Current Load"} 0',
-            'nagios_check_load_perf_data_value{hostname="localhost", key="load1", service="Current Load"} 0.560'
-        ]
-        # Setup fake get_services response.
-        json_response = json.dumps(self.services)
-        fixed16_header = fixed16('200', len(json_response))
-        fake_service_sock = FakeSocketIO(fixed16_header + json_response)
-        mock_exists.return_value = True
-        mock_connect.side_effect = [fake_status_sock, fake_service_sock]
+    @mock.patch.object(nagios_exporter, 'collect_metrics')
+    def test_make_app(self, mock_metrics):
+        app = nagios_exporter.make_app(parse_args([]))
+        # Older werkzeug releases, the last to support Python 2, return a
+        # plain tuple from Client requests unless given a response class.
+        client = werkzeug_test.Client(app, nagios_exporter.wrappers.Response)
 
-        values = []
-        nagios_exporter.collect_metrics(args, values)
+        metrics = client.get('/metrics')
+        missing = client.get('/')
+        post = client.post('/metrics')
 
-        self.assertItemsEqual(values, expected_status + expected_services)
+        self.assertEqual(metrics.status_code, 200)
+        self.assertEqual(
+            metrics.get_data(as_text=True), 'nagios_exporter_success 1\n')
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(post.status_code, 405)
+        self.assertEqual(mock_metrics.call_count, 1)
 
-    @mock.patch.object(nagios_exporter, 'connect')
-    @mock.patch.object(os.path, 'exists')
-    def test_collect_metrics_when_whitelist(
-        self, mock_exists, mock_connect):
-        args = nagios_exporter.parse_args(
-            ['--path=/not-a-real/path', '--whitelist=nagios_check_load_state'])
-        expected_status = [
-            'nagios_livestatus_available 1',
-            'nagios_thing_a 1',
-            'nagios_thing_b 0'
-        ]
-        # Setup fake get_status response.
-        json_response = json.dumps([['thing_a', 'thing_b'], [1, 0]])
-        fixed16_header = fixed16('200', len(json_response))
-        fake_status_sock = FakeSocketIO(fixed16_header + json_response)
-        expected_services = [
-            'nagios_check_load_state{hostname="localhost", service="Current Load"} 0',
-        ]
-        # Setup fake get_services response.
-        json_response = json.dumps(self.services)
-        fixed16_header = fixed16('200', len(json_response))
-        fake_service_sock = FakeSocketIO(fixed16_header + json_response)
-        mock_exists.return_value = True
-        mock_connect.side_effect = [fake_status_sock, fake_service_sock]
+    @mock.patch.dict(nagios_exporter._cache, {'lines': None, 'expires': 0})
+    @mock.patch.object(nagios_exporter, 'collect_metrics')
+    def test_metrics_with_cache_ttl(self, mock_metrics):
+        args = parse_args(['--cache_ttl=60'])
 
-        values = []
-        nagios_exporter.collect_metrics(args, values)
+        first = nagios_exporter.metrics(args)
+        second = nagios_exporter.metrics(args)
+
+        self.assertEqual(mock_metrics.call_count, 1)
+        self.assertEqual(first.get_data(), second.get_data())
+
+    @mock.patch.dict(nagios_exporter._cache, {'lines': None, 'expires': 0})
+    @mock.patch.object(nagios_exporter, 'collect_metrics')
+    def test_metrics_with_cache_ttl_when_concurrent(self, mock_metrics):
+        args = parse_args(['--cache_ttl=60'])
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_collect(unused_args, unused_lines):
+            started.set()
+            release.wait(5)
+        mock_metrics.side_effect = slow_collect
+
+        first = threading.Thread(target=nagios_exporter.metrics, args=(args,))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=nagios_exporter.metrics, args=(args,))
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(mock_metrics.call_count, 1)
+
+    @mock.patch.object(nagios_exporter, 'collect_metrics')
+    def test_metrics_without_cache_ttl(self, mock_metrics):
+        args = parse_args([])
+
+        nagios_exporter.metrics(args)
+        nagios_exporter.metrics(args)
 
-        self.assertItemsEqual(values, expected_status + expected_services)
+        self.assertEqual(mock_metrics.call_count, 2)
 
     @mock.patch.object(socket, 'socket')
     def test_connect(self, mock_socket):
@@ -283,57 +528,212 @@ class NagiosExporterTest(unittest.TestCase):
         self.assertEqual(mock_socket.call_count, 1)
         self.assertEqual(mock_conn.connect.call_count, 1)
 
-    def test_parse_value_and_unit(self):
-        self.assertEqual(
-            nagios_exporter.parse_value_and_unit('2400MB'), ('2400', 'MB'))
-        self.assertEqual(
-            nagios_exporter.parse_value_and_unit('30%'), ('30', '%'))
-        self.assertEqual(
-            nagios_exporter.parse_value_and_unit('0.323ms'), ('0.323', 'ms'))
-        self.assertEqual(
-            nagios_exporter.parse_value_and_unit('3.4'), ('3.4', ''))
-        self.assertEqual(
-            nagios_exporter.parse_value_and_unit('v0.3.4'), ('v0.3.4', ''))
+    @mock.patch.object(nagios_exporter, 'CHUNK_SIZE', 10)
+    def test_encode_lines(self):
+        lines = ['nagios_a 1', 'nagios_b 2', 'c 3']
+
+        actual = list(nagios_exporter.encode_lines(lines))
+
+        self.assertEqual(actual, [b'nagios_a 1\n', b'nagios_b 2\n', b'c 3\n'])
 
+    def test_encode_lines_in_one_chunk(self):
+        lines = ['nagios_a 1', 'nagios_b 2']
+
+        actual = list(nagios_exporter.encode_lines(lines))
+
+        self.assertEqual(actual, [b'nagios_a 1\nnagios_b 2\n'])
+
+    def test_encode_lines_when_empty(self):
+        self.assertEqual(list(nagios_exporter.encode_lines([])), [])
+
+    def test_parse_value_and_unit(self):
+        cases = (
+            ('2400MB', ('2400', 'MB')),
+            ('30%', ('30', '%')),
+            ('0.323ms', ('0.323', 'ms')),
+            ('3.4', ('3.4', '')),
+            ('v0.3.4', ('v0.3.4', '')),
+        )
+        for raw, expected in cases:
+            with self.subTest(raw=raw):
+                self.assertEqual(
+                    nagios_exporter.parse_value_and_unit(raw), expected)
+
+    def test_parse_value_and_unit_matches_oracle(self):
+        # Every string of up to five characters drawn from digits, dots,
+        # unit letters and other characters; about 20k inputs.
+        alphabet = '1.Bs%v-'
+        inputs = [''.join(chars)
+                  for length in range(6)
+                  for chars in itertools.product(alphabet, repeat=length)]
+
+        mismatches = [
+            raw for raw in inputs
+            if (nagios_exporter.parse_value_and_unit(raw) !=
+                oracle_value_and_unit(raw))]
+
+        self.assertEqual(mismatches, [])
+
+    @mock.patch.object(nagios_exporter, '_unknown_units', set())
     def test_convert_value_to_base_unit(self):
-        # Known unit.
-        self.assertEqual(
-            nagios_exporter.convert_value_to_base_unit('2400', 'KB'),
-            '2457600.0')
-        # No unit.
-        self.assertEqual(
-            nagios_exporter.convert_value_to_base_unit('2400', ''), '2400')
-        # Ignored / unknown unit.
-        self.assertEqual(
-            nagios_exporter.convert_value_to_base_unit('2400', 'hz'), '2400')
-        # Not a numeric value.
-        self.assertEqual(
-            nagios_exporter.convert_value_to_base_unit('v3.1', ''), 'v3.1')
-        # Not a numeric value with a known unit (e.g. coincidence or bad value)
-        self.assertEqual(
-            nagios_exporter.convert_value_to_base_unit('v3.1', 'KB'), 'v3.1KB')
+        cases = (
+            # Known unit.
+            ('2400', 'KB', '2457600.0'),
+            # No unit.
+            ('2400', '', '2400'),
+            # Ignored / unknown unit.
+            ('2400', 'hz', '2400'),
+            # Not a numeric value.
+            ('v3.1', '', 'v3.1'),
+            # Not a numeric value with a known unit (e.g. coincidence or bad
+            # value)
+            ('v3.1', 'KB', 'v3.1KB'),
+        )
+        for value, unit, expected in cases:
+            with self.subTest(value=value, unit=unit):
+                self.assertEqual(
+                    nagios_exporter.convert_value_to_base_unit(value, unit),
+                    expected)
+
+    @mock.patch.object(nagios_exporter, '_unknown_units', set())
+    @mock.patch.object(nagios_exporter.logging, 'warning')
+    def test_convert_value_to_base_unit_warns_once_per_unit(self, mock_warning):
+        nagios_exporter.convert_value_to_base_unit('1', 'hz')
+        nagios_exporter.convert_value_to_base_unit('2', 'hz')
+        nagios_exporter.convert_value_to_base_unit('3', 'rpm')
+
+        self.assertEqual(mock_warning.call_count, 2)
 
     def test_get_perf_data(self):
-        expected = [
-            ('check_disk_perf_data_used', {'key': '/'}, '2516582400.0'),
-            ('check_disk_perf_data_free', {'key': '/'}, '50704941056.0'),
-            ('check_disk_perf_data_total', {'key': '/'}, '63381176320.0')
-        ]
+        expected = (
+            ('check_disk_perf_data_used', '/', '2516582400.0'),
+            ('check_disk_perf_data_free', '/', '50704941056.0'),
+            ('check_disk_perf_data_total', '/', '63381176320.0'),
+        )
 
         actual = nagios_exporter.get_perf_data(
-            'check_disk', {},
+            'check_disk',
             ['/=2400MB;48356;54400;0;60445'],
-            ['check_disk=used;free;;;total'])
+            {'check_disk': ['used', 'free', '', '', 'total']})
+
+        self.assertEqual(sorted(actual), sorted(expected))
+
+    def test_get_perf_data_sanitizes_metric_names(self):
+        actual = nagios_exporter.get_perf_data(
+            'check-disk', ['/=10', '/var=20'], {'check-disk': ['used.bytes']})
 
-        self.assertItemsEqual(actual, expected)
+        self.assertEqual(sorted(actual), [
+            ('check_disk_perf_data_used_bytes', '/', '10'),
+            ('check_disk_perf_data_used_bytes', '/var', '20'),
+        ])
 
     def test_parse_perf_data_fields_with_good_values(self):
-        self.assertItemsEqual(
+        self.assertEqual(
                 {'/': ['2400MB', '48356', '54400', '0', '60445']},
                 nagios_exporter.parse_perf_data_fields(
                     ['/=2400MB;48356;54400;0;60445']))
     def test_parse_perf_data_fields_with_bad_values(self):
-        self.assertItemsEqual({}, nagios_exporter.parse_perf_data_fields(['-6]']))
+        self.assertEqual({}, nagios_exporter.parse_perf_data_fields(['-6]']))
+
+
+class CollectMetricsTest(unittest.TestCase):
+    """Tests collect_metrics with an existing socket and a fake connection."""
+
+    def setUp(self):
+        exists = mock.patch.object(os.path, 'exists', return_value=True)
+        connect = mock.patch.object(nagios_exporter, 'connect')
+        self.mock_exists = exists.start()
+        self.addCleanup(exists.stop)
+        self.mock_connect = connect.start()
+        self.addCleanup(connect.stop)
+        # Formatting services fills the command cache.
+        command_cache = mock.patch.dict(
+            nagios_exporter._command_cache, clear=True)
+        command_cache.start()
+        self.addCleanup(command_cache.stop)
+
+    def test_collect_metrics_when_all_metrics_is_true(self):
+        args = parse_args(
+            ['--path', '/not-a-real/path', '--all_metrics', '--perf_data'])
+        self.mock_connect.return_value = FakeSocketIO(
+            _STATUS_WIRE + _SERVICES_WIRE)
+
+        values = []
+        nagios_exporter.collect_metrics(args, values)
+
+        self.assertEqual(self.mock_connect.call_count, 1)
+        self.assertEqual(
+            sorted(values),
+            sorted(_EXPECTED_STATUS + _EXPECTED_SERVICES_WITH_PERF))
+
+    def test_collect_metrics_when_whitelist(self):
+        args = parse_args(
+            ['--path=/not-a-real/path', '--whitelist=nagios_check_load_state'])
+        self.mock_connect.return_value = FakeSocketIO(
+            _STATUS_WIRE + _SERVICES_WIRE)
+
+        values = []
+        nagios_exporter.collect_metrics(args, values)
+
+        self.assertEqual(
+            sorted(values),
+            sorted(_EXPECTED_STATUS + _EXPECTED_SERVICES_BASE[2:3]))
+
+    def test_collect_metrics_when_whitelist_patterns_overlap(self):
+        args = parse_args(
+            ['--path=/not-a-real/path', '--whitelist=check_load_state',
+             '--whitelist=_state{'])
+        self.mock_connect.return_value = FakeSocketIO(
+            _STATUS_A_WIRE + _SERVICES_WIRE)
+
+        values = []
+        nagios_exporter.collect_metrics(args, values)
+
+        self.assertEqual(values, [
+            'nagios_livestatus_available 1',
+            'nagios_thing_a 1',
+            'nagios_check_load_state{hostname="localhost", service="Current Load"} 0',
+        ])
+
+    @mock.patch.dict(
+        nagios_exporter._status_cache, {'entry': (None, 0)})
+    def test_collect_metrics_with_status_cache_ttl(self):
+        args = parse_args(
+            ['--path=/not-a-real/path', '--status_cache_ttl=60'])
+        self.mock_connect.return_value = FakeSocketIO(_STATUS_A_WIRE)
+        first = []
+        nagios_exporter.collect_metrics(args, first)
+        second = []
+        nagios_exporter.collect_metrics(args, second)
+
+        self.assertEqual(first, list(_EXPECTED_STATUS[:2]))
+        self.assertEqual(second, first)
+        # The cached status needs no second connection.
+        self.assertEqual(self.mock_connect.call_count, 1)
+
+    def test_collect_metrics_when_status_cache_refreshed_concurrently(self):
+        class RefreshedCache(dict):
+            """Simulates another scrape refreshing the cache after each read."""
+
+            def __getitem__(self, key):
+                value = dict.__getitem__(self, key)
+                self[key] = ([['thing_a'], [2]], time.time() + 60)
+                return value
+
+        args = parse_args(
+            ['--path=/not-a-real/path', '--status_cache_ttl=60'])
+        self.mock_connect.return_value = FakeSocketIO(_STATUS_A_WIRE)
+        cache = RefreshedCache(entry=(None, 0))
+
+        values = []
+        with mock.patch.object(nagios_exporter, '_status_cache', cache):
+            nagios_exporter.collect_metrics(args, values)
+
+        # The expired entry that was read is queried again, rather than
+        # pairing its missing status with the refreshed expiry.
+        self.assertEqual(values, list(_EXPECTED_STATUS[:2]))
+        self.assertEqual(self.mock_connect.call_count, 1)
+
 
 if __name__ == "__main__":  # pragma: no cover
     unittest.main()